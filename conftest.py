@@ -0,0 +1,25 @@
+"""
+Test configuration for cudamps.
+
+None of the tests need a GPU, so minimal stand-ins for pycuda and pytools are
+installed if those packages are not available.
+"""
+
+import sys
+import types
+
+try:
+    import pycuda.driver
+except ImportError:
+    pycuda = types.ModuleType('pycuda')
+    pycuda.driver = types.ModuleType('pycuda.driver')
+    pycuda.driver.init = lambda: None
+    sys.modules['pycuda'] = pycuda
+    sys.modules['pycuda.driver'] = pycuda.driver
+
+try:
+    import pytools
+except ImportError:
+    pytools = types.ModuleType('pytools')
+    pytools.memoize_method = lambda f: f
+    sys.modules['pytools'] = pytools
@@ -9,21 +9,322 @@ Python interface to CUDA Multi-Process Service.
 # Distributed under the terms of the BSD license:
 # http://www.opensource.org/licenses/bsd-license
 
+import array
+import collections
+import errno
+import gzip
+import math
 import os
 import re
+import shutil
+import signal
 import sys
 import tempfile
+import threading
+import time
 
 # Needed to support timeouts with Python 2.7:
 if sys.version_info < (3, 0):
     import subprocess32 as subprocess
+    _fsdecode = lambda buf: buf.tobytes()
 else:
     import subprocess
+    _fsdecode = lambda buf: str(buf, sys.getfilesystemencoding(),
+                                'surrogateescape')
 
 import pycuda.driver as drv
 import pytools
 
 MPS_CTRL_PROG = 'nvidia-cuda-mps-control'
+MPS_LOG_FILES = ['control.log', 'server.log']
+MPS_DEFAULT_LOG_DIR = '/var/log/nvidia-mps'
+
+class ProcEnvironCache(object):
+    """
+    LRU cache of parsed process environments.
+
+    Environments are read from `/proc/<pid>/environ` and cached by process ID
+    and start time so that a recycled process ID is never mistaken for the
+    process whose environment was cached.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of environments retained.
+    """
+
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _read(self, pid, name):
+        try:
+            with open('/proc/%i/%s' % (pid, name), 'rb') as f:
+                return f.read()
+        except (IOError, OSError) as e:
+            if e.errno in (errno.ENOENT, errno.ESRCH):
+                raise OSError(errno.ESRCH, 'process %i not found' % pid)
+            elif e.errno in (errno.EACCES, errno.EPERM):
+                raise OSError(e.errno, 'permission denied reading %s of '
+                              'process %i' % (name, pid))
+            raise
+
+    def _get_start_time(self, pid):
+        # The process name may contain spaces or parentheses, so fields are
+        # counted from the last parenthesis; the start time is field 22:
+        return int(self._read(pid, 'stat').rsplit(b')', 1)[1].split()[19])
+
+    def _parse(self, data):
+        # Entries are located with find() and decoded straight from views of
+        # the raw data so that no intermediate copies of them are made:
+        env = {}
+        buf = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            end = data.find(b'\0', pos)
+            if end < 0:
+                end = len(data)
+            sep = data.find(b'=', pos, end)
+            if sep >= 0:
+                env[_fsdecode(buf[pos:sep])] = _fsdecode(buf[sep+1:end])
+            pos = end+1
+        return env
+
+    def get(self, pid):
+        """
+        Retrieve environment of running process.
+
+        Parameters
+        ----------
+        pid : int
+            Process ID.
+
+        Returns
+        -------
+        env : dict
+            Process environment. The returned dict is shared with the cache
+            and must not be modified.
+
+        Raises
+        ------
+        OSError
+            If the process does not exist (`errno.ESRCH`) or its environment
+            cannot be read by the current user (`errno.EACCES`).
+        """
+
+        key = (pid, self._get_start_time(pid))
+        with self._lock:
+            env = self._cache.pop(key, None)
+            if env is not None:
+                self._cache[key] = env
+                return env
+
+        env = self._parse(self._read(pid, 'environ'))
+        if self._get_start_time(pid) != key[1]:
+            raise OSError(errno.ESRCH, 'process %i not found' % pid)
+        with self._lock:
+            self._cache[key] = env
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return env
+
+    def clear(self):
+        """
+        Remove all cached environments.
+        """
+
+        with self._lock:
+            self._cache.clear()
+
+class LogPolicy(object):
+    """
+    Policy for bounding the size of MPS log files.
+
+    Parameters
+    ----------
+    max_size : int
+        Size in bytes beyond which a log file is rotated.
+    retention : int
+        Number of rotated segments of each log file to keep. Older
+        segments are deleted.
+    compress : bool
+        If True, compress rotated segments with gzip. The most recent segment,
+        `<name>.1`, is always left uncompressed because the daemon may still be
+        writing to it; hence, nothing is compressed if `retention` is 1.
+    interval : float
+        Number of seconds between checks of the log file sizes.
+    """
+
+    def __init__(self, max_size=10*1024**2, retention=5, compress=True,
+                 interval=60.0):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+        if retention < 1:
+            raise ValueError('retention must be at least 1')
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        self.max_size = max_size
+        self.retention = retention
+        self.compress = compress
+        self.interval = interval
+
+class LogRotator(threading.Thread):
+    """
+    Rotate the log files of an MPS control daemon in the background.
+
+    The MPS control daemon closes and reopens its log files (and those of the
+    MPS server) when it receives SIGHUP. Log files that exceed the maximum size
+    specified by the policy are therefore renamed to `<name>.1` and the daemon
+    is signaled so that it resumes logging to new files. Because the daemon may
+    still write to `<name>.1` for a short while after being signaled, that
+    segment is only compressed when it is shifted to `<name>.2` by the next
+    rotation. None of this is done in the daemon's own write path, so logging
+    is never blocked.
+
+    Parameters
+    ----------
+    log_dir : str
+        Log directory of the MPS control daemon.
+    policy : LogPolicy
+        Log size and retention policy.
+    get_pid : callable
+        Function that returns the process ID of the MPS control daemon writing
+        to `log_dir`, or None if the daemon is not running.
+    """
+
+    # Number of consecutive checks that must fail to find the daemon before
+    # the rotator exits:
+    max_missed = 3
+
+    def __init__(self, log_dir, policy, get_pid):
+        super(LogRotator, self).__init__()
+        self.daemon = True
+        self.log_dir = log_dir
+        self.policy = policy
+        self.get_pid = get_pid
+        self._stop_event = threading.Event()
+
+    def _segment_name(self, name, i):
+        path = os.path.join(self.log_dir, '%s.%i' % (name, i))
+        if self.policy.compress and i > 1:
+            path += '.gz'
+        return path
+
+    def _compress(self, src, dest):
+        tmp = dest+'.tmp'
+        try:
+            with open(src, 'rb') as f_in:
+                with gzip.open(tmp, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            os.rename(tmp, dest)
+        except Exception:
+            # Leave the uncompressed segment in place so that it is picked up
+            # by the next rotation:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.remove(src)
+
+    def _shift_segments(self, name):
+        # Only shift segments up to the first gap, e.g., one left by a failed
+        # compression, so that retrying does not discard extra segments:
+        end = self.policy.retention
+        for i in range(2, self.policy.retention):
+            if not os.path.exists(self._segment_name(name, i)):
+                end = i
+                break
+        oldest = self._segment_name(name, end)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for i in range(end-1, 1, -1):
+            src = self._segment_name(name, i)
+            if os.path.exists(src):
+                os.rename(src, self._segment_name(name, i+1))
+
+        # The daemon reopened its logs when it was signaled by the previous
+        # rotation, so the first segment can now be safely compressed:
+        first = self._segment_name(name, 1)
+        if self.policy.retention > 1 and os.path.exists(first):
+            if self.policy.compress:
+                self._compress(first, self._segment_name(name, 2))
+            else:
+                os.rename(first, self._segment_name(name, 2))
+
+    def rotate(self, force=False):
+        """
+        Rotate log files that exceed the maximum size.
+
+        Parameters
+        ----------
+        force : bool
+            If True, rotate all nonempty log files regardless of their size.
+
+        Returns
+        -------
+        rotated : list
+            Names of the rotated log files.
+        """
+
+        return self._rotate(self.get_pid(), force)
+
+    def _rotate(self, pid, force=False):
+        rotated = []
+        try:
+            for name in MPS_LOG_FILES:
+                path = os.path.join(self.log_dir, name)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                if size == 0 or (size < self.policy.max_size and not force):
+                    continue
+
+                # Any failure to shift the older segments is raised before the
+                # current log is renamed, so no segment is ever overwritten:
+                self._shift_segments(name)
+                os.rename(path, self._segment_name(name, 1))
+                rotated.append(name)
+        finally:
+            # Signal the daemon even if a later log failed to rotate so that
+            # it stops writing to the logs that were already renamed:
+            if rotated and pid is not None:
+                try:
+                    os.kill(pid, signal.SIGHUP)
+                except OSError:
+                    pass
+        return rotated
+
+    def run(self):
+        missed = 0
+        while not self._stop_event.wait(self.policy.interval):
+            try:
+                pid = self.get_pid()
+            except (IOError, OSError):
+                pid = None
+            if pid is None:
+                missed += 1
+                if missed >= self.max_missed:
+                    break
+                continue
+            missed = 0
+            try:
+                self._rotate(pid)
+            except (IOError, OSError):
+                # Retry on the next check, e.g., if the directory was
+                # transiently full or unavailable:
+                pass
+
+    def stop(self):
+        """
+        Stop rotating log files.
+        """
+
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
 
 class MultiProcessServiceManager(object):
     """
@@ -33,11 +334,14 @@ class MultiProcessServiceManager(object):
     for multiple supported GPUs. Since no process states are stored in the cache
     instance, use of this class should not conflict with other tools that
     manipulate the control daemons (such as running the command-line management
-    program).
+    program). The only exception are the log rotators started for daemons
+    launched with a log policy.
     """
 
     def __init__(self):
         drv.init()
+        self._log_rotators = {}
+        self._environ_cache = ProcEnvironCache()
 
     def get_mps_ctrl_proc(self):
         """
@@ -50,13 +354,39 @@ class MultiProcessServiceManager(object):
             the first is returned.
         """
 
+        pids = self.get_mps_ctrl_procs()
+        if pids:
+            return pids[0]
+        else:
+            return None
+
+    def get_mps_ctrl_procs(self):
+        """
+        Find all running MPS control daemons.
+
+        Returns
+        -------
+        pids : list
+            MPS control daemon process IDs.
+        """
+
         try:
             out = subprocess.check_output(['pgrep', '-u',
                     str(os.getuid()), '-fx', '%s -d' % MPS_CTRL_PROG])
         except subprocess.CalledProcessError:
-            return None
+            return []
         else:
-            return int(out.split()[0])
+            return [int(pid) for pid in out.split()]
+
+    def _find_mps_ctrl_proc(self, mps_dir):
+        """
+        Find running MPS control daemon that uses the specified pipe directory.
+        """
+
+        for pid in self.get_mps_ctrl_procs():
+            if self.get_mps_dir(pid) == mps_dir:
+                return pid
+        return None
 
     def _get_proc_environ(self, pid):
         """
@@ -69,17 +399,23 @@ class MultiProcessServiceManager(object):
 
         Returns
         -------
-        data : str
-            Process environment.
+        env : dict
+            Process environment, or None if the process is not found.
+
+        Raises
+        ------
+        OSError
+            If the environment of the process cannot be read by the current
+            user (`errno.EACCES`).
         """
 
         try:
-            f = open('/proc/%i/environ' % pid, 'r')
-        except:
-            return ''
-        else:
-            return f.read().replace('\0', '\n')
-        
+            return self._environ_cache.get(pid)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return None
+            raise
+
     def get_mps_dir(self, pid):
         """
         Find pipe directory for MPS control daemon process.
@@ -94,15 +430,139 @@ class MultiProcessServiceManager(object):
         mps_dir : str
             Pipe directory associated with specified process. Returns None
             if the process is not found or is not an MPS control daemon.
+
+        Raises
+        ------
+        OSError
+            If the environment of the process cannot be read by the current
+            user (`errno.EACCES`).
         """
 
-        data = self._get_proc_environ(pid)
-        r = re.search('^CUDA_MPS_PIPE_DIRECTORY=(.*)$',
-                      data, re.MULTILINE)
-        try:
-            return r.group(1)
-        except:
+        env = self._get_proc_environ(pid)
+        if env is None:
+            return None
+        return env.get('CUDA_MPS_PIPE_DIRECTORY')
+
+    def get_mps_log_dir(self, pid):
+        """
+        Find log directory for MPS control daemon process.
+
+        Parameters
+        ----------
+        pid : int
+            MPS control daemon process ID.
+
+        Returns
+        -------
+        log_dir : str
+            Log directory associated with specified process. Returns None
+            if the process is not found.
+
+        Raises
+        ------
+        OSError
+            If the environment of the process cannot be read by the current
+            user (`errno.EACCES`).
+        """
+
+        env = self._get_proc_environ(pid)
+        if env is None:
+            return None
+        return env.get('CUDA_MPS_LOG_DIRECTORY', MPS_DEFAULT_LOG_DIR)
+
+    def get_visible_devs(self, pid):
+        """
+        Find GPUs visible to MPS control daemon process.
+
+        Parameters
+        ----------
+        pid : int
+            MPS control daemon process ID.
+
+        Returns
+        -------
+        devs : list
+            Entries of `CUDA_VISIBLE_DEVICES` in the environment of the
+            specified process. Returns None if the process is not found or
+            the variable is not set, i.e., all devices are visible.
+
+        Raises
+        ------
+        OSError
+            If the environment of the process cannot be read by the current
+            user (`errno.EACCES`).
+        """
+
+        env = self._get_proc_environ(pid)
+        if env is None or 'CUDA_VISIBLE_DEVICES' not in env:
             return None
+        return [d.strip() for d in env['CUDA_VISIBLE_DEVICES'].split(',')
+                if d.strip()]
+
+    def _ctrl_command(self, pid, cmd):
+        """
+        Send a command to a running MPS control daemon.
+
+        Parameters
+        ----------
+        pid : int
+            MPS control daemon process ID.
+        cmd : str
+            Command to send.
+
+        Returns
+        -------
+        out : str
+            Output of the command.
+        """
+
+        mps_dir = self.get_mps_dir(pid)
+        if not mps_dir:
+            raise ValueError('process %i is not an MPS control daemon' % pid)
+        env = dict(os.environ)
+        env['CUDA_MPS_PIPE_DIRECTORY'] = mps_dir
+        p = subprocess.Popen([MPS_CTRL_PROG], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, env=env,
+                             universal_newlines=True)
+        return p.communicate(cmd+'\n')[0]
+
+    def get_server_list(self, pid):
+        """
+        Find MPS servers managed by a control daemon.
+
+        Parameters
+        ----------
+        pid : int
+            MPS control daemon process ID.
+
+        Returns
+        -------
+        server_pids : list
+            MPS server process IDs.
+        """
+
+        out = self._ctrl_command(pid, 'get_server_list')
+        return [int(s) for s in out.split()]
+
+    def get_client_list(self, pid, server_pid):
+        """
+        Find clients connected to an MPS server.
+
+        Parameters
+        ----------
+        pid : int
+            MPS control daemon process ID.
+        server_pid : int
+            MPS server process ID.
+
+        Returns
+        -------
+        client_pids : list
+            MPS client process IDs.
+        """
+
+        out = self._ctrl_command(pid, 'get_client_list %i' % server_pid)
+        return [int(s) for s in out.split()]
 
     @pytools.memoize_method
     def get_supported_devs(self):
@@ -124,7 +584,7 @@ class MultiProcessServiceManager(object):
                 result.append(i)
         return result
 
-    def start(self, mps_dir=None):
+    def start(self, mps_dir=None, log_dir=None, log_policy=None):
         """
         Start MPS control daemon.
 
@@ -132,16 +592,23 @@ class MultiProcessServiceManager(object):
         ----------
         mps_dir : str
             Pipe directory to be used by daemon. If no directory is
-            specified, a new temporary directory is created. Logs are written to
-            this directory too.
+            specified, a new temporary directory is created.
+        log_dir : str
+            Log directory to be used by daemon. If no directory is specified,
+            logs are written to the pipe directory.
+        log_policy : LogPolicy
+            If specified, the daemon's log files are rotated in the background
+            according to this policy until the daemon is stopped.
         """
 
         if mps_dir is None:
             mps_dir = tempfile.mkdtemp()
+        if log_dir is None:
+            log_dir = mps_dir
 
         env = os.environ
         env['CUDA_MPS_PIPE_DIRECTORY'] = mps_dir
-        env['CUDA_MPS_LOG_DIRECTORY'] = mps_dir
+        env['CUDA_MPS_LOG_DIRECTORY'] = log_dir
         p = subprocess.Popen([MPS_CTRL_PROG, '-d'],
                              stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE,
@@ -154,6 +621,15 @@ class MultiProcessServiceManager(object):
             if 'An instance of this daemon is already running' in out:
                 raise RuntimeError('running daemon already using %s' % mps_dir)
 
+        rotator = self._log_rotators.pop(mps_dir, None)
+        if rotator is not None:
+            rotator.stop()
+        if log_policy is not None:
+            rotator = LogRotator(log_dir, log_policy,
+                                 lambda: self._find_mps_ctrl_proc(mps_dir))
+            rotator.start()
+            self._log_rotators[mps_dir] = rotator
+
     def stop(self, pid, clean=False):
         """
         Stop MPS control daemon.
@@ -164,13 +640,429 @@ class MultiProcessServiceManager(object):
             MPS control daemon process ID.
         clean : bool
             If True, delete the pipe directory associated with the daemon.
+
+        Raises
+        ------
+        ValueError
+            If the process is not found or is not an MPS control daemon.
+        OSError
+            If the environment of the process cannot be read by the current
+            user (`errno.EACCES`).
         """
 
         mps_dir = self.get_mps_dir(pid)
         if mps_dir:
+            rotator = self._log_rotators.pop(mps_dir, None)
+            if rotator is not None:
+                rotator.stop()
             env = os.environ
             env['CUDA_MPS_PIPE_DIRECTORY'] = mps_dir
             p = subprocess.Popen([MPS_CTRL_PROG], stdin=subprocess.PIPE)
             p.communicate('quit\n')
         else:
             raise ValueError('error stopping process %i' % pid)
+
+class UtilizationSource(object):
+    """
+    Source of per-process GPU utilization readings.
+
+    Subclasses must implement `get_utilization()`; a subclass that returns
+    synthetic readings can be used to exercise `ClientSampler` without a GPU.
+    """
+
+    def get_utilization(self, pids=None):
+        """
+        Read current GPU utilization of processes.
+
+        Parameters
+        ----------
+        pids : collection
+            Process IDs of interest. If None, readings for all processes that
+            use a GPU are returned.
+
+        Returns
+        -------
+        util : dict
+            Utilization percentages keyed by (device ID, process ID) tuples.
+
+        Raises
+        ------
+        IOError
+            If the readings cannot be obtained.
+        """
+
+        raise NotImplementedError
+
+class NVMLUtilizationSource(UtilizationSource):
+    """
+    Per-process SM utilization readings obtained via NVML.
+
+    Requires `pynvml`. Device IDs are NVML device indices, which only match
+    CUDA device IDs if `CUDA_DEVICE_ORDER` is set to `PCI_BUS_ID`.
+    """
+
+    def __init__(self):
+        import pynvml
+        pynvml.nvmlInit()
+        self._nvml = pynvml
+        self._last_seen = {}
+
+    def get_utilization(self, pids=None):
+        nvml = self._nvml
+        result = {}
+        try:
+            count = nvml.nvmlDeviceGetCount()
+            handles = [nvml.nvmlDeviceGetHandleByIndex(i) for i in range(count)]
+        except nvml.NVMLError as e:
+            raise IOError('error querying devices via NVML: %s' % e)
+        for i, h in enumerate(handles):
+            try:
+                samples = nvml.nvmlDeviceGetProcessUtilization(
+                    h, self._last_seen.get(i, 0))
+            except nvml.NVMLError:
+                # Raised if no samples were taken since the last query:
+                continue
+            for s in samples:
+                self._last_seen[i] = max(self._last_seen.get(i, 0), s.timeStamp)
+                if pids is None or s.pid in pids:
+                    result[(i, s.pid)] = max(result.get((i, s.pid), 0), s.smUtil)
+        return result
+
+ClientShare = collections.namedtuple('ClientShare',
+        ['device', 'pid', 'name', 'mean', 'p95', 'mean_util', 'samples'])
+
+class ClientSampleBuffer(object):
+    """
+    Fixed-size ring buffer of per-client GPU utilization samples.
+
+    Samples are stored in preallocated arrays, so memory use does not grow
+    with the number of samples recorded; once the buffer is full, the oldest
+    records are overwritten. The samples taken at each tick must be preceded
+    by a call to `mark()` so that clients without a sample in some ticks are
+    treated as idle during those ticks.
+
+    Parameters
+    ----------
+    capacity : int
+        Maximum number of records (samples and tick marks) retained.
+    """
+
+    # Device and process ID of records that mark the start of a tick:
+    _TICK = -1
+
+    def __init__(self, capacity=4096):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self._times = array.array('d', [0.0])*capacity
+        self._devs = array.array('i', [0])*capacity
+        self._pids = array.array('l', [0])*capacity
+        self._utils = array.array('d', [0.0])*capacity
+        self._shares = array.array('d', [0.0])*capacity
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def _append(self, t, dev, pid, util, share):
+        with self._lock:
+            i = self._next
+            self._times[i] = t
+            self._devs[i] = dev
+            self._pids[i] = pid
+            self._utils[i] = util
+            self._shares[i] = share
+            self._next = (i+1) % self.capacity
+            self._count = min(self._count+1, self.capacity)
+
+    def mark(self, t):
+        """
+        Record the start of a tick.
+
+        Parameters
+        ----------
+        t : float
+            Tick time in seconds since the epoch.
+        """
+
+        self._append(t, self._TICK, self._TICK, 0.0, 0.0)
+
+    def append(self, t, dev, pid, util, share):
+        """
+        Record a sample.
+
+        Parameters
+        ----------
+        t : float
+            Sample time in seconds since the epoch.
+        dev : int
+            Device ID.
+        pid : int
+            Client process ID.
+        util : float
+            Utilization percentage of the device by the client.
+        share : float
+            Fraction of the device's total utilization due to the client.
+        """
+
+        self._append(t, dev, pid, util, share)
+
+    def pids(self):
+        """
+        Return the set of client process IDs in the buffer.
+        """
+
+        with self._lock:
+            return set(self._pids[i] for i in self._indices()
+                       if self._pids[i] != self._TICK)
+
+    def _indices(self):
+        start = (self._next-self._count) % self.capacity
+        return [(start+k) % self.capacity for k in range(self._count)]
+
+    def samples(self, window=None, now=None):
+        """
+        Collect client samples recorded within a time window.
+
+        Parameters
+        ----------
+        window : float
+            Length of window in seconds ending at `now`. If None, all ticks
+            in the buffer up to `now` are used.
+        now : float
+            End of window in seconds since the epoch. Defaults to the current
+            time.
+
+        Returns
+        -------
+        ticks : int
+            Number of ticks in the window.
+        samples : dict
+            Lists of (share, utilization) tuples keyed by (device ID, process
+            ID) tuples with one entry per tick, oldest first. Ticks without a
+            sample for a client are filled with zeros.
+        """
+
+        if now is None:
+            now = time.time()
+        ticks = 0
+        found = {}
+        with self._lock:
+            in_window = False
+            for i in self._indices():
+                if self._pids[i] == self._TICK:
+                    in_window = self._times[i] <= now and \
+                        (window is None or self._times[i] >= now-window)
+                    if in_window:
+                        ticks += 1
+                elif in_window:
+                    # Samples whose tick mark was overwritten are skipped
+                    # because in_window is initially False:
+                    key = (self._devs[i], self._pids[i])
+                    found.setdefault(key, {})[ticks-1] = \
+                        (self._shares[i], self._utils[i])
+        result = {}
+        for key, entries in found.items():
+            result[key] = [entries.get(k, (0.0, 0.0)) for k in range(ticks)]
+        return ticks, result
+
+    def shares(self, window=None, now=None):
+        """
+        Collect client shares recorded within a time window.
+
+        Parameters
+        ----------
+        window : float
+            Length of window in seconds ending at `now`. If None, all ticks
+            in the buffer up to `now` are used.
+        now : float
+            End of window in seconds since the epoch. Defaults to the current
+            time.
+
+        Returns
+        -------
+        shares : dict
+            Lists of shares keyed by (device ID, process ID) tuples with one
+            entry per tick, oldest first.
+        """
+
+        samples = self.samples(window, now)[1]
+        return dict((key, [share for share, util in entries])
+                    for key, entries in samples.items())
+
+def _percentile(values, q):
+    """
+    Compute percentile of a list of values using the nearest-rank method.
+    """
+
+    values = sorted(values)
+    return values[max(0, int(math.ceil(q/100.0*len(values)))-1)]
+
+class ClientSampler(threading.Thread):
+    """
+    Periodically sample GPU share of MPS clients.
+
+    Parameters
+    ----------
+    source : UtilizationSource
+        Source of per-process utilization readings.
+    manager : MultiProcessServiceManager
+        Manager used to query the clients of the MPS control daemon. If None,
+        the processes reported by `source` in each tick are sampled.
+    pid : int
+        MPS control daemon process ID. Defaults to the first running daemon.
+    capacity : int
+        Maximum number of records retained. Each tick uses one record plus
+        one per client and active device.
+    interval : float
+        Number of seconds between samples.
+    """
+
+    def __init__(self, source, manager=None, pid=None, capacity=4096,
+                 interval=1.0):
+        super(ClientSampler, self).__init__()
+        self.daemon = True
+        self.source = source
+        self.manager = manager
+        self.pid = pid
+        self.interval = interval
+        self.buffer = ClientSampleBuffer(capacity)
+        self._names = {}
+        self._last_clients = set()
+        self._stop_event = threading.Event()
+
+    def get_clients(self):
+        """
+        Find MPS clients of the control daemon.
+
+        Returns
+        -------
+        pids : set
+            Client process IDs, or None if no manager was specified.
+        """
+
+        if self.manager is None:
+            return None
+        pid = self.pid
+        if pid is None:
+            pid = self.manager.get_mps_ctrl_proc()
+            if pid is None:
+                return set()
+        clients = set()
+        for server_pid in self.manager.get_server_list(pid):
+            clients.update(self.manager.get_client_list(pid, server_pid))
+        return clients
+
+    def _get_name(self, pid):
+        try:
+            with open('/proc/%i/comm' % pid, 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def sample(self, now=None):
+        """
+        Record utilization of all clients.
+
+        Every client is recorded on every device that had any activity, with
+        zero utilization if the source did not report a reading for it.
+
+        Parameters
+        ----------
+        now : float
+            Sample time in seconds since the epoch. Defaults to the current
+            time.
+        """
+
+        if now is None:
+            now = time.time()
+        clients = self.get_clients()
+        if clients is not None and not clients:
+            self.buffer.mark(now)
+            self._last_clients = set()
+            return
+
+        # Read all processes so that shares are relative to the total
+        # utilization of each device, including that of non-clients:
+        util = self.source.get_utilization()
+        if clients is None:
+            clients = set(pid for dev, pid in util)
+        totals = {}
+        for (dev, pid), u in util.items():
+            totals[dev] = totals.get(dev, 0)+u
+
+        # Only start the tick once the readings were obtained so that a failed
+        # read is not recorded as a tick in which all clients were idle:
+        self.buffer.mark(now)
+        for dev in sorted(totals):
+            for pid in clients:
+                u = util.get((dev, pid), 0)
+                share = float(u)/totals[dev] if totals[dev] else 0.0
+                self.buffer.append(now, dev, pid, u, share)
+
+        # Refresh the names of clients that (re)appear since their process IDs
+        # may have been reused:
+        for pid in clients:
+            if pid not in self._last_clients or pid not in self._names:
+                self._names[pid] = self._get_name(pid)
+        self._last_clients = clients
+
+        # Keep the name cache bounded by the buffer's contents:
+        if len(self._names) > self.buffer.capacity:
+            live = self.buffer.pids()
+            for pid in list(self._names):
+                if pid not in live:
+                    del self._names[pid]
+
+    def aggregate(self, window=None, now=None):
+        """
+        Compute statistics of client GPU share within a time window.
+
+        Parameters
+        ----------
+        window : float
+            Length of window in seconds ending at `now`. If None, all retained
+            samples are used.
+        now : float
+            End of window in seconds since the epoch. Defaults to the current
+            time.
+
+        Returns
+        -------
+        result : list of ClientShare
+            Mean and 95th percentile share and mean utilization of each client
+            on each device over all ticks in the window, sorted by decreasing
+            mean share.
+        """
+
+        ticks, samples = self.buffer.samples(window, now)
+        result = []
+        for (dev, pid), entries in samples.items():
+            shares = [share for share, util in entries]
+            utils = [util for share, util in entries]
+            result.append(ClientShare(dev, pid, self._names.get(pid),
+                                      sum(shares)/ticks,
+                                      _percentile(shares, 95),
+                                      sum(utils)/ticks, ticks))
+        result.sort(key=lambda c: c.mean, reverse=True)
+        return result
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.sample()
+            except (IOError, OSError, ValueError):
+                # Skip samples taken while the daemon or its clients are
+                # starting or exiting:
+                pass
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
@@ -52,4 +52,5 @@ if __name__ == "__main__":
         long_description = LONG_DESCRIPTION,
         url = URL,
         py_modules = ['cudamps'],
-        install_requires = install_requires)
+        install_requires = install_requires,
+        extras_require = {'nvml': ['pynvml']})
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+"""
+Tests for cudamps.
+"""
+
+import errno
+import gzip
+import io
+import os
+import signal
+import sys
+import types
+
+import pytest
+
+import cudamps
+
+def _write_log(log_dir, name, data):
+    with open(os.path.join(log_dir, name), 'w') as f:
+        f.write(data)
+
+def _read_segment(log_dir, name):
+    path = os.path.join(log_dir, name)
+    if name.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return f.read().decode()
+    with open(path, 'r') as f:
+        return f.read()
+
+@pytest.fixture
+def signals(monkeypatch):
+    sent = []
+    monkeypatch.setattr(cudamps.os, 'kill',
+                        lambda pid, sig: sent.append((pid, sig)))
+    return sent
+
+def _rotator(log_dir, **kwargs):
+    kwargs.setdefault('max_size', 10)
+    return cudamps.LogRotator(str(log_dir), cudamps.LogPolicy(**kwargs),
+                              lambda: 1234)
+
+def test_rotate_segments(tmpdir, signals):
+    rotator = _rotator(tmpdir, retention=3)
+    for k in range(5):
+        _write_log(str(tmpdir), 'server.log', 'log%i' % k*10)
+        assert rotator.rotate() == ['server.log']
+    assert sorted(os.listdir(str(tmpdir))) == \
+        ['server.log.1', 'server.log.2.gz', 'server.log.3.gz']
+    assert [_read_segment(str(tmpdir), name)[:4] for name in
+            ['server.log.1', 'server.log.2.gz', 'server.log.3.gz']] == \
+        ['log4', 'log3', 'log2']
+    assert signals == [(1234, signal.SIGHUP)]*5
+
+def test_rotate_below_max_size(tmpdir, signals):
+    rotator = _rotator(tmpdir, max_size=100)
+    _write_log(str(tmpdir), 'server.log', 'short')
+    assert rotator.rotate() == []
+    assert rotator.rotate(force=True) == ['server.log']
+    assert os.listdir(str(tmpdir)) == ['server.log.1']
+    assert signals == [(1234, signal.SIGHUP)]
+
+def test_rotate_uncompressed(tmpdir, signals):
+    rotator = _rotator(tmpdir, retention=2, compress=False)
+    for k in range(3):
+        _write_log(str(tmpdir), 'control.log', 'log%i' % k*10)
+        rotator.rotate()
+    assert sorted(os.listdir(str(tmpdir))) == ['control.log.1', 'control.log.2']
+    assert _read_segment(str(tmpdir), 'control.log.2')[:4] == 'log1'
+
+def test_rotate_retention_one(tmpdir, signals):
+    rotator = _rotator(tmpdir, retention=1)
+    for k in range(3):
+        _write_log(str(tmpdir), 'server.log', 'log%i' % k*10)
+        rotator.rotate()
+    assert os.listdir(str(tmpdir)) == ['server.log.1']
+    assert _read_segment(str(tmpdir), 'server.log.1')[:4] == 'log2'
+
+def test_rotate_retry_after_failed_compression(tmpdir, signals, monkeypatch):
+    rotator = _rotator(tmpdir, retention=3)
+    for k in range(3):
+        _write_log(str(tmpdir), 'server.log', 'log%i' % k*10)
+        rotator.rotate()
+
+    def fail(*args):
+        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    with monkeypatch.context() as m:
+        m.setattr(cudamps.shutil, 'copyfileobj', fail)
+        _write_log(str(tmpdir), 'server.log', 'log3'*10)
+        for _ in range(2):
+            with pytest.raises(IOError):
+                rotator.rotate()
+
+    # The uncompressed segment is kept and no partial archive is left:
+    assert sorted(os.listdir(str(tmpdir))) == \
+        ['server.log', 'server.log.1', 'server.log.3.gz']
+    assert rotator.rotate() == ['server.log']
+    assert [_read_segment(str(tmpdir), name)[:4] for name in
+            ['server.log.1', 'server.log.2.gz', 'server.log.3.gz']] == \
+        ['log3', 'log2', 'log1']
+
+def test_rotate_partial_failure_signals(tmpdir, signals, monkeypatch):
+    rotator = _rotator(tmpdir)
+    _write_log(str(tmpdir), 'control.log', 'x'*20)
+    _write_log(str(tmpdir), 'server.log', 'y'*20)
+    shift = rotator._shift_segments
+    def fail(name):
+        if name == 'server.log':
+            raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        shift(name)
+    monkeypatch.setattr(rotator, '_shift_segments', fail)
+    with pytest.raises(IOError):
+        rotator.rotate()
+    assert sorted(os.listdir(str(tmpdir))) == ['control.log.1', 'server.log']
+    assert signals == [(1234, signal.SIGHUP)]
+
+def test_rotator_exits_without_daemon(tmpdir):
+    rotator = cudamps.LogRotator(str(tmpdir), cudamps.LogPolicy(interval=0.01),
+                                 lambda: None)
+    rotator.start()
+    rotator.join(5)
+    assert not rotator.is_alive()
+
+class SyntheticSource(cudamps.UtilizationSource):
+    """
+    Utilization source that replays a list of readings, one per tick.
+    """
+
+    def __init__(self, readings):
+        self.readings = list(readings)
+
+    def get_utilization(self, pids=None):
+        util = self.readings.pop(0)
+        if pids is None:
+            return dict(util)
+        return dict((k, v) for k, v in util.items() if k[1] in pids)
+
+class SyntheticManager(object):
+    """
+    Stand-in for MultiProcessServiceManager with a fixed set of clients.
+    """
+
+    def __init__(self, clients):
+        self.clients = clients
+
+    def get_mps_ctrl_proc(self):
+        return 1
+
+    def get_server_list(self, pid):
+        return [2]
+
+    def get_client_list(self, pid, server_pid):
+        return list(self.clients)
+
+def test_buffer_wraparound():
+    buf = cudamps.ClientSampleBuffer(capacity=5)
+    for t in range(3):
+        buf.mark(t)
+        buf.append(t, 0, 10+t, 10.0, 1.0)
+    assert len(buf) == 5
+
+    # The mark of tick 0 was overwritten, so its remaining sample is ignored:
+    ticks, samples = buf.samples(now=3)
+    assert ticks == 2
+    assert samples == {(0, 11): [(1.0, 10.0), (0.0, 0.0)],
+                       (0, 12): [(0.0, 0.0), (1.0, 10.0)]}
+    assert buf.pids() == set([10, 11, 12])
+
+def test_buffer_shares_window():
+    buf = cudamps.ClientSampleBuffer(capacity=16)
+    for t, share in enumerate([0.1, 0.2, 0.3, 0.4]):
+        buf.mark(t)
+        buf.append(t, 0, 10, 0.0, share)
+    assert buf.shares(window=1.5, now=3) == {(0, 10): [0.3, 0.4]}
+    assert buf.shares(now=3) == {(0, 10): [0.1, 0.2, 0.3, 0.4]}
+    assert buf.shares(window=0.5, now=10) == {}
+
+def test_buffer_shares_fills_missing_ticks():
+    buf = cudamps.ClientSampleBuffer(capacity=16)
+    for t in range(3):
+        buf.mark(t)
+    buf.append(2, 0, 10, 50.0, 1.0)
+    assert buf.shares(now=3) == {(0, 10): [0.0, 0.0, 1.0]}
+
+def test_buffer_shares_window_before_newest_tick():
+    buf = cudamps.ClientSampleBuffer(capacity=16)
+    for t, share in enumerate([0.1, 0.2, 0.3, 0.4]):
+        buf.mark(t)
+        buf.append(t, 0, 10, 0.0, share)
+    assert buf.shares(window=1.5, now=1) == {(0, 10): [0.1, 0.2]}
+    assert buf.shares(now=2) == {(0, 10): [0.1, 0.2, 0.3]}
+
+def test_percentile_single_value():
+    assert cudamps._percentile([0.5], 95) == 0.5
+
+def test_percentile_nearest_rank():
+    values = list(range(20, 0, -1))
+    assert cudamps._percentile(values, 95) == 19
+    assert cudamps._percentile(values, 100) == 20
+
+def test_sampler_share_per_device():
+    source = SyntheticSource([{(0, 10): 30, (0, 11): 10, (1, 11): 20}])
+    sampler = cudamps.ClientSampler(source)
+    sampler.sample(now=0)
+    shares = sampler.buffer.shares(now=1)
+    assert shares[(0, 10)] == [0.75]
+    assert shares[(0, 11)] == [0.25]
+    assert shares[(1, 11)] == [1.0]
+
+    # Clients without activity on an active device are recorded as idle:
+    assert shares[(1, 10)] == [0.0]
+
+def test_sampler_share_includes_non_clients():
+    source = SyntheticSource([{(0, 10): 30, (0, 12): 70}])
+    sampler = cudamps.ClientSampler(source, manager=SyntheticManager([10]))
+    sampler.sample(now=0)
+    assert sampler.buffer.shares(now=1) == {(0, 10): [0.3]}
+
+def test_sampler_failed_read():
+    class FailingSource(cudamps.UtilizationSource):
+        def get_utilization(self, pids=None):
+            raise IOError('no readings')
+    sampler = cudamps.ClientSampler(FailingSource(),
+                                    manager=SyntheticManager([10]))
+    with pytest.raises(IOError):
+        sampler.sample(now=0)
+    assert len(sampler.buffer) == 0
+
+def test_nvml_source_device_error(monkeypatch):
+    class NVMLError(Exception):
+        pass
+    def fail():
+        raise NVMLError('GPU is lost')
+    pynvml = types.ModuleType('pynvml')
+    pynvml.NVMLError = NVMLError
+    pynvml.nvmlInit = lambda: None
+    pynvml.nvmlDeviceGetCount = fail
+    monkeypatch.setitem(sys.modules, 'pynvml', pynvml)
+    with pytest.raises(IOError):
+        cudamps.NVMLUtilizationSource().get_utilization()
+
+def test_sampler_idle_ticks():
+    readings = [{(0, 10): 50, (0, 11): 50}] + [{(0, 11): 40}]*99
+    sampler = cudamps.ClientSampler(SyntheticSource(readings),
+                                    manager=SyntheticManager([10, 11]))
+    for t in range(100):
+        sampler.sample(now=t)
+    result = dict((c.pid, c) for c in sampler.aggregate(now=100))
+    assert result[10].samples == 100
+    assert result[10].mean == pytest.approx(0.005)
+    assert result[10].p95 == 0.0
+    assert result[10].mean_util == pytest.approx(0.5)
+    assert result[11].mean == pytest.approx(0.995)
+
+def test_sampler_no_activity():
+    sampler = cudamps.ClientSampler(SyntheticSource([{}]*5),
+                                    manager=SyntheticManager([10]))
+    for t in range(5):
+        sampler.sample(now=t)
+    assert sampler.aggregate(now=5) == []
+
+class FakeProc(object):
+    """
+    Fake `/proc` that serves process files from a dict and counts reads.
+    """
+
+    def __init__(self, procs):
+        self.procs = procs
+        self.reads = []
+
+    def open(self, path, mode='r'):
+        pid, name = path.split('/')[2:]
+        self.reads.append((int(pid), name))
+        files = self.procs.get(int(pid))
+        if files is None:
+            raise IOError(errno.ENOENT, 'No such file or directory', path)
+        data = files[name]
+        if isinstance(data, int):
+            raise IOError(data, os.strerror(data), path)
+        return io.BytesIO(data)
+
+def _stat(pid, start_time):
+    return ('%i (fake (name)) S 1 %i %i 0 -1 4194560 100 0 0 0 0 0 0 0 20 0 '
+            '1 0 %i 1000 100' % (pid, pid, pid, start_time)).encode()
+
+@pytest.fixture
+def fake_proc(monkeypatch):
+    procs = {}
+    for pid in (100, 101, 102):
+        procs[pid] = {'stat': _stat(pid, 1000+pid),
+                      'environ': ('PID=%i\0' % pid).encode()}
+    procs[200] = {'stat': _stat(200, 1200), 'environ': errno.EACCES}
+    procs[300] = {'stat': _stat(300, 1300),
+                  'environ': b'CUDA_MPS_PIPE_DIRECTORY=/tmp/mps\0'
+                             b'CUDA_VISIBLE_DEVICES= 0, ,2 ,\0'}
+    procs[301] = {'stat': _stat(301, 1301),
+                  'environ': b'CUDA_MPS_PIPE_DIRECTORY=/tmp/mps2\0'
+                             b'CUDA_MPS_LOG_DIRECTORY=/tmp/log2\0'}
+    proc = FakeProc(procs)
+    monkeypatch.setattr(cudamps, 'open', proc.open, raising=False)
+    return proc
+
+def test_environ_parse():
+    env = cudamps.ProcEnvironCache()._parse(
+        b'A=1\0B=x=y\0NOEQUALS\0C=\0')
+    assert env == {'A': '1', 'B': 'x=y', 'C': ''}
+
+def test_environ_parse_unterminated():
+    env = cudamps.ProcEnvironCache()._parse(b'A=1\0B=2')
+    assert env == {'A': '1', 'B': '2'}
+
+def test_environ_start_time(fake_proc):
+    assert cudamps.ProcEnvironCache()._get_start_time(100) == 1100
+
+def test_environ_cache_hit(fake_proc):
+    cache = cudamps.ProcEnvironCache()
+    assert cache.get(100) == {'PID': '100'}
+    assert cache.get(100) == {'PID': '100'}
+    assert [r for r in fake_proc.reads if r[1] == 'environ'] == \
+        [(100, 'environ')]
+
+def test_environ_cache_pid_reuse(fake_proc):
+    cache = cudamps.ProcEnvironCache()
+    cache.get(100)
+    fake_proc.procs[100] = {'stat': _stat(100, 5000),
+                            'environ': b'PID=reused\0'}
+    assert cache.get(100) == {'PID': 'reused'}
+
+def test_environ_cache_lru_eviction(fake_proc):
+    cache = cudamps.ProcEnvironCache(maxsize=2)
+    cache.get(100)
+    cache.get(101)
+    cache.get(100)
+    cache.get(102)
+    assert list(cache._cache) == [(100, 1100), (102, 1102)]
+
+def test_environ_missing_pid(fake_proc):
+    with pytest.raises(OSError) as e:
+        cudamps.ProcEnvironCache().get(999)
+    assert e.value.errno == errno.ESRCH
+
+def test_environ_permission_denied(fake_proc):
+    with pytest.raises(OSError) as e:
+        cudamps.ProcEnvironCache().get(200)
+    assert e.value.errno == errno.EACCES
+
+def test_manager_environ_missing_pid(fake_proc):
+    man = cudamps.MultiProcessServiceManager()
+    assert man._get_proc_environ(999) is None
+    assert man.get_mps_dir(999) is None
+    assert man.get_mps_log_dir(999) is None
+    assert man.get_visible_devs(999) is None
+
+def test_manager_environ_permission_denied(fake_proc):
+    man = cudamps.MultiProcessServiceManager()
+    with pytest.raises(OSError) as e:
+        man.get_mps_dir(200)
+    assert e.value.errno == errno.EACCES
+
+def test_manager_mps_dirs(fake_proc):
+    man = cudamps.MultiProcessServiceManager()
+    assert man.get_mps_dir(300) == '/tmp/mps'
+    assert man.get_mps_log_dir(300) == cudamps.MPS_DEFAULT_LOG_DIR
+    assert cudamps.MPS_DEFAULT_LOG_DIR == '/var/log/nvidia-mps'
+    assert man.get_mps_dir(301) == '/tmp/mps2'
+    assert man.get_mps_log_dir(301) == '/tmp/log2'
+    assert man.get_mps_dir(100) is None
+
+def test_manager_visible_devs(fake_proc):
+    man = cudamps.MultiProcessServiceManager()
+    assert man.get_visible_devs(300) == ['0', '2']
+    assert man.get_visible_devs(301) is None